@@ -1,124 +1,371 @@
+import argparse
+import sys
+from dataclasses import dataclass
+from functools import cached_property
+
 import gdb
-from treelib import Tree
+
+# Mnemonics of call instructions besides x86's call/callq/calll
+CALL_MNEMONICS = ("bl", "blx", "blr", "jal", "jalr")
+
+# Function names by the start address of the function's block, kept across invocations
+NAME_CACHE = {}
+
+
+def real_frame(frame):
+    """Returns frame, or the frame of the function that frame's code is inlined into."""
+    while frame is not None and frame.type() == gdb.INLINE_FRAME:
+        frame = frame.older()
+    return frame
+
+
+def function_block(frame):
+    """Returns the block of frame's function, or None without debug info."""
+    try:
+        block = frame.block()
+    except RuntimeError:
+        return None
+    while block.function is None:
+        block = block.superblock
+    return block
+
+
+def frame_name(frame, block):
+    """Returns frame.name(), resolving it once per function block."""
+    if block is None:
+        # No debug info for this frame, nothing stable to key on
+        return frame.name()
+    if block.start not in NAME_CACHE:
+        NAME_CACHE[block.start] = frame.name()
+    return NAME_CACHE[block.start]
+
+
+def clear_name_cache(event):
+    """Forgets cached names when the loaded symbols change."""
+    NAME_CACHE.clear()
+
+
+@dataclass
+class FrameInfo:
+    """Snapshot of a frame whose GDB accessors are evaluated at most once."""
+
+    frame: gdb.Frame
+
+    @cached_property
+    def block(self):
+        return function_block(self.frame)
+
+    @cached_property
+    def name(self):
+        return frame_name(self.frame, self.block)
+
+    @cached_property
+    def older(self):
+        return real_frame(self.frame.older())
+
+    @cached_property
+    def pc(self):
+        return self.frame.pc()
+
+
+class CallSiteBreakpoint(gdb.Breakpoint):
+    """Internal breakpoint on a call instruction of a traced function.
+
+    It only stops in the frame being traced and below the depth limit, so a
+    finish out of a deeper subtree runs to completion in a single stop. Inlined
+    code counts as part of the function it is inlined into: calls made from it
+    are traced, but inlined functions themselves do not appear in the tree.
+    """
+
+    def __init__(self, command, address):
+        super(CallSiteBreakpoint, self).__init__(f"*{address:#x}", internal=True)
+        self.command = command
+
+    def stop(self):
+        command = self.command
+        return (
+            not command.done
+            and command.current_depth < command.depth_limit
+            and real_frame(gdb.newest_frame()) == command.last_info.frame
+        )
+
 
 class CallTreeCommand(gdb.Command):
-    """Generates a call tree up to a specified depth by stepping into calls.
+    """Generates a call tree up to a specified depth by stopping at call sites.
 
     Usage:
-        call-tree --depth N
+        call-tree [--depth N | --depth=N] [--verbose]
     """
 
     def __init__(self):
         super(CallTreeCommand, self).__init__("call-tree", gdb.COMMAND_USER)
+        self.parser = argparse.ArgumentParser(prog="call-tree")
+        self.parser.add_argument("--depth", type=int, default=2)
+        self.parser.add_argument("--verbose", action="store_true")
         self.max_depth = 2
-        self.call_tree = Tree()  # Use treelib.Tree to store the tree structure
+        self.depth_limit = 2  # Depth at which we step out, lowered while unwinding recursion
+        self.verbose = False  # Report every function visited once the trace is done
+        self.log = []  # (depth, function) pairs buffered while verbose
+        # The tree is stored flat in insertion order, one entry per node
+        self.names = []  # Function name of each node
+        self.depths = []  # Depth of each node, the root is at 0
+        self.parents = []  # Index of each node's parent, -1 for the root
         self.current_depth = 0
-        self.done = False
+        self.depth_exact = True  # False when current_depth is only a lower bound
+        self.done = True  # No trace is running until invoke starts one
         self.initial_frame = None  # Store the initial frame for depth calculation
-        self.node_counter = 0  # Counter to generate unique node IDs
-        self.current_parent = None  # Track the current parent node
+        self.frame_info = None  # Cached newest frame, cleared when the inferior resumes
+        self.last_info = None  # Frame seen at the previous stop
+        self.last_older = None  # Caller of last_info, resolved while that frame is live
+        self.parent_stack = []  # Node indices of the active calls, innermost last
+        self.breakpoints = []  # Internal breakpoints created for this trace
+        self.call_sites = set()  # Addresses of call instructions with a breakpoint
+        self.armed = set()  # Start addresses of functions whose calls are armed
+
+        # Hook inferior events once, the handlers idle while done is set
+        gdb.events.stop.connect(self.stop_handler)
+        gdb.events.cont.connect(self.cont_handler)
+        gdb.events.exited.connect(self.exit_handler)
 
     def invoke(self, arg, from_tty):
         """Parses arguments and starts the process."""
-        # Parse depth argument
-        args = arg.split()
-        if len(args) == 2 and args[0] == "--depth":
-            try:
-                self.max_depth = int(args[1])
-            except ValueError:
-                print("Error: Depth must be an integer.")
-                return
+        try:
+            self.start(arg)
+        except BaseException:
+            # Never leave a half-started trace for the stop handler to pick up
+            self.abort()
+            raise
+
+    def start(self, arg):
+        """Resets the state and runs to the first call."""
+        # Parse arguments, argparse reports errors itself and exits
+        try:
+            args = self.parser.parse_args(gdb.string_to_argv(arg))
+        except SystemExit:
+            return
+
+        # End any trace still running before its state is reset
+        self.abort()
+        self.max_depth = args.depth
+        self.depth_limit = self.max_depth
+        self.verbose = args.verbose
 
         # Reset state
-        self.call_tree = Tree()
+        self.names, self.depths, self.parents = [], [], []
+        self.log = []
         self.current_depth = 0
-        self.done = False
-        self.node_counter = 0
-        self.current_parent = None
+        self.depth_exact = True
+        self.parent_stack = []
 
         # Store the initial frame
-        self.initial_frame = gdb.newest_frame()
+        self.initial_frame = real_frame(gdb.newest_frame())
         if not self.initial_frame:
             print("Error: no initial frame")
             return
+        self.last_info = FrameInfo(self.initial_frame)
+        self.last_older = self.last_info.older
+        self.frame_info = None
 
         # Add the root node (initial function)
-        initial_function = self.initial_frame.name()
-        root_node_id = "root"
-        self.call_tree.create_node(initial_function, root_node_id)  # Root node with ID "root"
-        self.current_parent = root_node_id  # Set the root node as the initial parent
-
-        # Hook stop event
-        gdb.events.stop.connect(self.stop_handler)
+        root = self.create_node(self.last_info.name, 0, -1)
+        self.parent_stack = [root]  # Set the root node as the initial parent
 
-        # Start stepping
-        gdb.execute("step")
-        return
+        # Run to the first call
+        self.done = False
+        self.watch_function(self.last_info)
+        self.resume(self.last_info)
 
     def stop_handler(self, event):
         """Handles breakpoints and function calls."""
         if self.done:
             return
 
-        frame = gdb.newest_frame()
-        if not frame:
-            print("Error: no frame")
+        try:
+            self.handle_stop()
+        except BaseException:
+            # GDB only prints errors raised in event handlers, end the trace ourselves
+            self.abort()
+            raise
+
+    def handle_stop(self):
+        """Updates the tree for the current stop and resumes the inferior."""
+        if self.frame_info is None:
+            frame = real_frame(gdb.newest_frame())
+            if not frame:
+                print("Error: no frame")
+                return
+            self.frame_info = FrameInfo(frame)
+        info = self.frame_info
+        frame = info.frame
+
+        # Still in the same function, nothing in the tree can change
+        if frame == self.last_info.frame:
+            self.resume(info)
             return
 
-        # Calculate the depth relative to the initial frame
-        temp_frame = frame
+        # Update the depth relative to the initial frame from the previous stop
         previous_depth = self.current_depth
-        self.current_depth = 0
-        while temp_frame and temp_frame != self.initial_frame:
+        if self.depth_exact and info.older == self.last_info.frame:
+            # We stepped into a call
             self.current_depth += 1
-            temp_frame = temp_frame.older()
+        elif self.depth_exact and frame == self.last_older:
+            # We returned to the caller
+            self.current_depth -= 1
+        else:
+            # Unexpected transition (signal, longjmp, ...), recount
+            self.current_depth = self.compute_depth(frame)
+            # Counting stops past max_depth, so a deeper result is only a lower bound
+            self.depth_exact = self.current_depth <= self.max_depth
+        # The frame may have returned by the next stop, so resolve its caller now
+        self.last_info = info
+        self.last_older = info.older
+
+        if self.current_depth > self.depth_limit:
+            # Too deep to record anything, just step out
+            self.resume(info)
+            return
 
-        function_name = frame.name()
-        print(f"current function: {function_name}")
-        print(f"current depth: {self.current_depth}")
+        function_name = info.name
+        if self.verbose:
+            self.log.append((self.current_depth, function_name))
 
         # we know that we are not at max depth, because if we were we would have stepped out to a lower depth
         if self.current_depth == previous_depth:
-            gdb.execute("step")
+            self.resume(info)
             return
 
         # Add the current function to the tree
-        if self.current_depth == 0:
+        if self.current_depth <= 0:
             # We are back at the root node
             # Stop execution if we have returned back to the initial function
             self.done = True
-            gdb.events.stop.disconnect(self.stop_handler)
+            self.delete_breakpoints()
             self.save_tree()
+            self.flush_log()
             return
 
         elif self.current_depth > previous_depth:
             # We stepped into a new function
-            node_id = f"node_{self.node_counter}"
-            self.node_counter += 1
-            self.call_tree.create_node(function_name, node_id, parent=self.current_parent)
-            self.current_parent = node_id  # Update the current parent
+            # Unnamed frames cannot be told apart, so never treat them as recursion
+            recursive = function_name is not None and any(
+                self.names[node] == function_name for node in self.parent_stack
+            )
+            if recursive:
+                function_name += " [recursion]"
+            node = self.create_node(function_name, self.current_depth, self.parent_stack[-1])
+            self.parent_stack.append(node)  # Update the current parent
+            if recursive:
+                # Unwind instead of expanding the same calls again
+                self.depth_limit = self.current_depth
+            elif self.current_depth < self.depth_limit:
+                self.watch_function(info)
         elif self.current_depth < previous_depth:
-            # We stepped out of a function
-            # Find the parent node by moving up the tree
-            parent_node = self.call_tree.parent(self.current_parent)
-            if parent_node:
-                self.current_parent = parent_node.identifier
-
-        # decide what to do (step in or out)
-        if self.current_depth == 0:
-            pass
-        elif self.current_depth < self.max_depth:
-            # Step into the next function call
+            # We stepped out of one or more functions, drop them all at once
+            while len(self.parent_stack) > max(self.current_depth, 0) + 1:
+                self.parent_stack.pop()
+            if self.current_depth < self.depth_limit:
+                # Back above any recursion being unwound
+                self.depth_limit = self.max_depth
+
+        # decide what to do (step in, run to the next call, or step out)
+        self.resume(info)
+
+    def resume(self, info):
+        """Runs the inferior to the next call or return we care about."""
+        if self.current_depth >= self.depth_limit:
+            # We are at max depth or in a recursive call, step out
+            gdb.execute("finish")
+        elif info.pc in self.call_sites:
+            # Step into the function called here
             gdb.execute("step")
-            return
         else:
-            # We are at max depth OR returning from a function
-            gdb.execute("finish")
+            # Run until the next armed call site or return
+            gdb.execute("continue")
+
+    def watch_function(self, info):
+        """Sets breakpoints on the calls made by info's function and on its return."""
+        frame = info.frame
+        try:
+            self.breakpoints.append(gdb.FinishBreakpoint(frame, internal=True))
+        except ValueError:
+            # Outermost frame, there is nothing to return to
+            pass
+
+        block = info.block
+        if block is None:
+            # No debug info, step would not enter this function anyway
+            return
+        if block.start in self.armed:
             return
+        self.armed.add(block.start)
+
+        for insn in frame.architecture().disassemble(block.start, block.end - 1):
+            mnemonic = insn["asm"].split(None, 1)[0]
+            if mnemonic.startswith("call") or mnemonic in CALL_MNEMONICS:
+                address = insn["addr"]
+                self.breakpoints.append(CallSiteBreakpoint(self, address))
+                self.call_sites.add(address)
+
+    def delete_breakpoints(self):
+        """Removes the breakpoints created by watch_function."""
+        for bp in self.breakpoints:
+            if bp.is_valid():
+                bp.delete()
+        self.breakpoints = []
+        self.call_sites = set()
+        self.armed = set()
+
+    def exit_handler(self, event):
+        """Ends the trace if the inferior exits before it returns to the initial frame."""
+        if not self.done:
+            print(f"call-tree: inferior exited before returning to {self.names[0] or '??'}")
+            # Everything recorded so far is still a valid tree
+            self.save_tree()
+            self.abort()
+
+    def abort(self):
+        """Ends the trace without saving the tree."""
+        self.done = True
+        self.delete_breakpoints()
+        self.flush_log()
+
+    def cont_handler(self, event):
+        """Drops the cached frame once the inferior resumes."""
+        self.frame_info = None
+
+    def compute_depth(self, frame):
+        """Counts the frames between frame and the initial frame, up to max_depth + 1."""
+        depth = 0
+        while frame and frame != self.initial_frame and depth <= self.max_depth:
+            depth += 1
+            frame = real_frame(frame.older())
+        return depth
+
+    def create_node(self, name, depth, parent):
+        """Appends a node to the tree and returns its index."""
+        self.names.append(name)
+        self.depths.append(depth)
+        self.parents.append(parent)
+        return len(self.names) - 1
 
     def save_tree(self):
         """Formats and saves the call tree."""
-        self.call_tree.save2file("tree.txt")  # Save the tree to a file
+        # Nodes are stored in call order, so indenting by depth gives the tree
+        indents = ["\t" * depth for depth in range(max(self.depths, default=0) + 1)]
+        lines = [indents[depth] + (name or "??") for name, depth in zip(self.names, self.depths)]
+        with open("tree.txt", "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def flush_log(self):
+        """Writes the buffered verbose log in a single write and clears it."""
+        if self.log:
+            sys.stdout.write("".join(
+                f"current function: {function_name}\ncurrent depth: {depth}\n"
+                for depth, function_name in self.log
+            ))
+            self.log = []
 
 # Register command
+gdb.events.new_objfile.connect(clear_name_cache)
+gdb.events.clear_objfiles.connect(clear_name_cache)
 CallTreeCommand()
\ No newline at end of file